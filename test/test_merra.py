@@ -1,4 +1,11 @@
 import unittest
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import numpy as np
+import h5py
 import wdata.merra as m
 import wdata.main
 from datetime import date
@@ -26,4 +33,117 @@ class TestCreateURL(unittest.TestCase):
         settings = m.PRESETS['merra2']
         url,label = m.create_url(date(1980,1,1),'wind',settings=settings,filefmt='nc4',revision=0,bbox=(30,-15,75,42.5))
         correct_url = "http://goldsmr4.gesdisc.eosdis.nasa.gov/daac-bin/OTF/HTTP_services.cgi?VERSION=1.02&BBOX=30%2C-15%2C75%2C42.5&SERVICE=SUBSET_MERRA2&FORMAT=bmM0Lw&VARIABLES=v2m%2Cv10m%2Cv50m%2Cu2m%2Cu10m%2Cu50m%2Cdisph&LABEL=svc_MERRA2_100.tavg1_2d_slv_Nx.19800101.nc4&SHORTNAME=M2T1NXSLV&FILENAME=%2Fdata%2Fs4pa%2FMERRA2%2FM2T1NXSLV.5.12.4%2F1980%2F01%2FMERRA2_100.tavg1_2d_slv_Nx.19800101.nc4"
-        self.assertEqual(url, correct_url)
\ No newline at end of file
+        self.assertEqual(url, correct_url)
+
+
+class TestMemoryBudget(unittest.TestCase):
+    def test_no_limit(self):
+        self.assertEqual(m.memory_budget(None), (None,None))
+
+    def test_split(self):
+        buffer_bytes,cache_bytes = m.memory_budget(4)
+        self.assertEqual(cache_bytes, int(4*1024**2*m.CHUNK_CACHE_SHARE))
+        self.assertEqual(buffer_bytes+cache_bytes, 4*1024**2)
+
+
+# Clean MERRA2 data in a separate process and print the peak RSS increase in kB
+MEMORY_SCRIPT = """
+import sys
+import wdata.merra as m
+
+def status(key):
+    for line in open('/proc/self/status'):
+        if line.startswith(key+':'):
+            return int(line.split()[1])
+
+source,dest,max_memory = sys.argv[1],sys.argv[2],float(sys.argv[3])
+# Reset the peak RSS so that only memory used while cleaning is counted
+with open('/proc/self/clear_refs','w') as f:
+    f.write('5')
+before = status('VmRSS')
+m.clean_merra2(source,dest,skip_existing=False,datatype='wind',max_memory=max_memory)
+print(status('VmHWM')-before)
+"""
+
+
+class TestCleanMerra2(unittest.TestCase):
+    variables = ['U10M','V10M','U50M']
+    shape = (24,10,12)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir,'source')
+        os.mkdir(self.source)
+        rng = np.random.RandomState(0)
+        for day in range(1,4):
+            fname = 'svc_MERRA2_100.tavg1_2d_slv_Nx.198001{:02d}.nc4'.format(day)
+            with h5py.File(os.path.join(self.source,fname),'w') as f:
+                f['time'] = np.arange(0,24*60,60)
+                f['lat'] = np.linspace(30,75,self.shape[1])
+                f['lon'] = np.linspace(-15,42.5,self.shape[2])
+                for v in self.variables:
+                    f.create_dataset(v,data=rng.rand(*self.shape).astype('float32'),
+                        chunks=(5,self.shape[1],self.shape[2]),compression='gzip')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def clean(self,max_memory):
+        dest = os.path.join(self.tmpdir,'dest_{}'.format(max_memory))
+        os.mkdir(dest)
+        m.clean_merra2(self.source,dest,skip_existing=False,datatype='wind',max_memory=max_memory)
+        return os.path.join(dest,'tavg1_2d_slv_Nx.1980.hdf')
+
+    def test_same_output_as_unbounded(self):
+        unbounded = self.clean(None)
+        bounded = self.clean(0.02)
+        with h5py.File(unbounded,'r') as f1, h5py.File(bounded,'r') as f2:
+            self.assertEqual(sorted(f1), sorted(f2))
+            for k in f1:
+                np.testing.assert_array_equal(f1[k][:], f2[k][:])
+            np.testing.assert_array_equal(f2['u10m'][24*3:], 0)
+
+
+@unittest.skipUnless(os.path.exists('/proc/self/clear_refs'),'peak RSS can only be reset on Linux')
+class TestCleanMerra2Memory(unittest.TestCase):
+    # One day of data is about 4.4 MB, which fits once in the buffer of an
+    # 8 MB budget but not twice
+    shape = (24,200,240)
+    max_memory = 8
+    baseline_memory = 0.25
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir,'source')
+        os.mkdir(self.source)
+        rng = np.random.RandomState(0)
+        for day in range(1,4):
+            fname = 'svc_MERRA2_100.tavg1_2d_slv_Nx.198001{:02d}.nc4'.format(day)
+            with h5py.File(os.path.join(self.source,fname),'w') as f:
+                f['time'] = np.arange(0,24*60,60)
+                f['lat'] = np.linspace(30,75,self.shape[1])
+                f['lon'] = np.linspace(-15,42.5,self.shape[2])
+                f.create_dataset('U10M',data=rng.rand(*self.shape).astype('float32'),
+                    chunks=(1,self.shape[1],self.shape[2]))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def peak_rss(self,max_memory):
+        dest = os.path.join(self.tmpdir,'dest_{}'.format(max_memory))
+        os.mkdir(dest)
+        env = dict(os.environ)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env['PYTHONPATH'] = os.pathsep.join(p for p in [env.get('PYTHONPATH'),root] if p)
+        # Keep freed arrays from staying in the heap so that RSS follows live memory
+        env['MALLOC_MMAP_THRESHOLD_'] = '65536'
+        out = subprocess.check_output([sys.executable,'-c',MEMORY_SCRIPT,
+            self.source,dest,str(max_memory)],env=env)
+        return int(out.split()[-1])
+
+    def test_peak_rss_within_budget(self):
+        # Memory used apart from buffered data and chunk cache (libraries,
+        # time index) is measured with a budget that only fits one time step
+        baseline = self.peak_rss(self.baseline_memory)
+        peak = self.peak_rss(self.max_memory)
+        self.assertLessEqual(peak-baseline, self.max_memory*1024)
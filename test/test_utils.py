@@ -0,0 +1,85 @@
+import unittest
+import numpy as np
+import wdata.utils as u
+
+class RecordingDataset:
+    """Array wrapper that records the size of each write"""
+    def __init__(self, shape):
+        self.data = np.zeros(shape)
+        self.writes = []
+
+    def __setitem__(self, key, value):
+        self.writes.append(value.nbytes)
+        self.data[key] = value
+
+
+class TestRowNbytes(unittest.TestCase):
+    def test_row_nbytes(self):
+        self.assertEqual(u.row_nbytes(np.zeros((24,10,10),dtype='float32')), 400)
+
+
+class ChunkedArray:
+    """Array stand-in with an HDF5-like chunk shape"""
+    def __init__(self, shape, chunks):
+        self.shape = shape
+        self.chunks = chunks
+        self.dtype = np.dtype('float64')
+
+
+class TestRowsWithinBudget(unittest.TestCase):
+    def test_no_limit(self):
+        self.assertEqual(u.rows_within_budget(np.zeros((24,10,10)),None), 24)
+
+    def test_limit(self):
+        # One row of 10x10 float64 is 800 bytes
+        self.assertEqual(u.rows_within_budget(np.zeros((24,10,10)),2000), 2)
+
+    def test_at_least_one_row(self):
+        self.assertEqual(u.rows_within_budget(np.zeros((24,10,10)),100), 1)
+
+    def test_whole_chunks(self):
+        # 7 rows fit in the budget, rounded down to one chunk of 5 rows
+        self.assertEqual(u.rows_within_budget(ChunkedArray((24,10,10),(5,10,10)),7*800), 5)
+
+    def test_less_than_one_chunk(self):
+        self.assertEqual(u.rows_within_budget(ChunkedArray((24,10,10),(5,10,10)),3*800), 3)
+
+    def test_all_rows_with_chunks(self):
+        self.assertEqual(u.rows_within_budget(ChunkedArray((24,10,10),(5,10,10)),30*800), 24)
+
+
+class TestWriteBuffer(unittest.TestCase):
+    def test_write_through(self):
+        outfile = {'a': RecordingDataset((48,10,10))}
+        buf = u.WriteBuffer(outfile)
+        buf.add('a',0,np.ones((24,10,10)))
+        self.assertEqual(len(outfile['a'].writes), 1)
+        self.assertEqual(buf.nbytes, 0)
+
+    def test_reserve_flushes(self):
+        outfile = {'a': RecordingDataset((48,10,10))}
+        buf = u.WriteBuffer(outfile,1600)
+        buf.add('a',0,np.ones((1,10,10)))
+        buf.reserve(800)
+        self.assertEqual(len(outfile['a'].writes), 0)
+        buf.reserve(801)
+        self.assertEqual(len(outfile['a'].writes), 1)
+        self.assertEqual(buf.nbytes, 0)
+
+    def test_stays_within_budget(self):
+        outfile = {'a': RecordingDataset((48,10,10)), 'b': RecordingDataset((48,10,10))}
+        max_bytes = 4*800
+        buf = u.WriteBuffer(outfile,max_bytes)
+        for start in range(48):
+            for name in ['a','b']:
+                data = np.full((1,10,10),start)
+                buf.reserve(data.nbytes)
+                # Buffered data and the slice in flight must fit together
+                self.assertLessEqual(buf.nbytes+data.nbytes, max_bytes)
+                buf.add(name,start,data)
+        self.assertGreater(len(outfile['a'].writes), 0)
+        buf.flush()
+        self.assertEqual(buf.nbytes, 0)
+        for name in ['a','b']:
+            self.assertEqual(len(outfile[name].writes), 48)
+            np.testing.assert_array_equal(outfile[name].data[:,0,0], np.arange(48))
@@ -66,6 +66,8 @@ def download(years,datasource,logfile,dest,**kwargs):
 @click.option('--datatype','-t',type=click.Choice(['wind', 'solar']),required=False)
 @click.option('--skip-existing/--no-skip-existing',default=True,
     help='skip cleaning if output file already exists (default True)')
+@click.option('--max-memory','-m',type=click.IntRange(min=1),required=False,
+    help='memory budget in MB for buffered data and the input chunk cache (MERRA2 only, default unlimited)')
 def clean(datasource,**kwargs):
     if 'merra' in datasource:
         import merra
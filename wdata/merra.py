@@ -80,6 +80,10 @@ BBOX_PRESETS = {
     'europe': (30,-15,75,42.5)
 }
 
+# Share of the cleaning memory budget used for the HDF5 chunk cache of the
+# input dataset being read, the rest is used for buffered data
+CHUNK_CACHE_SHARE = 0.25
+
 def create_url(date,datatype,settings,filefmt,revision,bbox='europe'):
     """
     Create URL string to download MERRA data from a given dataset for specific date.
@@ -210,6 +214,8 @@ def clean_merra(source,dest,skip_existing,ext='hdf',out_ext='hdf',datatype=None,
         datatype: either 'wind','solar', or None
     """
     logger.debug('Applying MERRA data cleaning function.')
+    if kwargs.get('max_memory') is not None:
+        logger.warning('Memory budget is not supported for MERRA data and will be ignored.')
 
     import h5py
     import pyhdf.SD as h4
@@ -284,7 +290,32 @@ def clean_merra(source,dest,skip_existing,ext='hdf',out_ext='hdf',datatype=None,
                         logger.warning('Filename could not be parsed: '+fname)
 
 
-def clean_merra2(source,dest,skip_existing,ext='nc4',out_ext='hdf',datatype=None,**kwargs):
+def memory_budget(max_memory):
+    """
+    Split a memory budget between the write buffer and the HDF5 chunk cache.
+
+    Each open dataset gets its own chunk cache of this size. While cleaning,
+    each input variable is closed before the next one is opened, so one
+    variable's cache is held at a time (time, latitude and longitude are
+    small and read whole). Chunks larger than the cache bypass it and are
+    not counted in the budget. Output datasets are contiguous, so no chunk
+    cache is used for them.
+
+    Args:
+        max_memory (number): memory budget in MB, or None for no limit
+
+    Returns:
+        A tuple with buffer size and input chunk cache size in bytes
+        (None if there is no limit).
+    """
+    if max_memory is None:
+        return (None,None)
+    total = int(max_memory*1024**2)
+    cache_bytes = int(total*CHUNK_CACHE_SHARE)
+    return (total-cache_bytes,cache_bytes)
+
+
+def clean_merra2(source,dest,skip_existing,ext='nc4',out_ext='hdf',datatype=None,max_memory=None,**kwargs):
     """
     Concatenate MERRA2 data from separate files into one file for each year.
 
@@ -293,11 +324,21 @@ def clean_merra2(source,dest,skip_existing,ext='nc4',out_ext='hdf',datatype=None
         dest (str): path to save output
         ext (str): extension for data files
         datatype: either 'wind','solar', or None
+        max_memory (number): memory budget in MB for buffered data and the
+            input chunk cache, or None to read each file and variable whole.
+            Buffered data and the slice being read stay within the budget
+            unless a single time step of a variable is larger than the
+            buffer. The yearly time index and input chunks larger than the
+            chunk cache are not counted.
     """
     logger.debug('Applying MERRA2 data cleaning function.')
     import h5py
     import re
 
+    buffer_bytes,cache_bytes = memory_budget(max_memory)
+    in_kwargs = {} if cache_bytes is None else {'rdcc_nbytes': cache_bytes}
+    logger.debug('Buffer size: {}, chunk cache size: {}.'.format(buffer_bytes,cache_bytes))
+
     files = sorted(glob.glob(os.path.join(source,'*.'+ext)))
 
     # Set dataset name to match based on datatype if set
@@ -326,6 +367,7 @@ def clean_merra2(source,dest,skip_existing,ext='nc4',out_ext='hdf',datatype=None
             logger.info('{} exists. Skipping.'.format(out_path))
         else:
             with h5py.File(out_path) as outfile:
+                buf = utils.WriteBuffer(outfile,buffer_bytes)
                 for path in files:
                     logger.debug('Path is {} (type: {}).'.format(path,type(path)))
                     # Extract name of file only and search for date
@@ -337,7 +379,7 @@ def clean_merra2(source,dest,skip_existing,ext='nc4',out_ext='hdf',datatype=None
                         cur_time = datetime.datetime.strptime(m.group('date'), '%Y%m%d')
                         start_hour = int((cur_time - start_time).total_seconds()/3600)
                         logger.debug('Reading file for {}: {}'.format(cur_time,fname))
-                        with h5py.File(path.encode('ascii')) as h5_file:
+                        with h5py.File(path.encode('ascii'),'r',**in_kwargs) as h5_file:
                             ts = h5_file['time'][:]
                             lats = h5_file['lat'][:]
                             longs = h5_file['lon'][:]
@@ -355,8 +397,19 @@ def clean_merra2(source,dest,skip_existing,ext='nc4',out_ext='hdf',datatype=None
                                     logger.debug('Creating dataset {} with size ({},{},{}).'.format(v.lower(),numhours,numlats,numlongs))
                                     outfile.create_dataset(v.lower(),(numhours,numlats,numlongs))
                                 
-                                data = h5_file[v][:]
-                                logger.debug('Assign \'{}\', time steps {}:{}, data with shape {}'.format(v.lower(),start_hour,start_hour+len(ts),str(data.shape)))
-                                outfile[v.lower()][start_hour:start_hour+len(ts),:,:] = data
+                                # Read in time slices that fit within the buffer budget,
+                                # flushing before each read if the slice would not fit.
+                                # Slices are passed straight to the buffer so that no
+                                # reference to a flushed slice is kept during the next read.
+                                dset = h5_file[v]
+                                step = utils.rows_within_budget(dset,buffer_bytes)
+                                for i in range(0,len(ts),step):
+                                    rows = min(step,len(ts)-i)
+                                    buf.reserve(rows*utils.row_nbytes(dset))
+                                    logger.debug('Assign \'{}\', time steps {}:{}'.format(v.lower(),start_hour+i,start_hour+i+rows))
+                                    buf.add(v.lower(),start_hour+i,dset[i:i+rows])
+                                # Close the dataset and its chunk cache before opening the next
+                                del dset
                     else:
-                        logger.warning('Filename could not be parsed: '+fname)
\ No newline at end of file
+                        logger.warning('Filename could not be parsed: '+fname)
+                buf.flush()
\ No newline at end of file
@@ -186,4 +186,89 @@ def retry_with_args(func,args,exc=Exception,delay=0):
         except exc as e:
             logger.debug("Call with argument '{}' failed: {}.".format(a,e))
         time.sleep(delay)
-    raise Exception("No working argument found.")
\ No newline at end of file
+    raise Exception("No working argument found.")
+
+
+def row_nbytes(dset):
+    """
+    Size in bytes of one row along the first axis of a dataset.
+
+    Args:
+        dset: h5py dataset (or anything with shape and dtype)
+
+    Returns:
+        int: number of bytes in one row
+    """
+    nbytes = dset.dtype.itemsize
+    for n in dset.shape[1:]:
+        nbytes *= n
+    return nbytes
+
+
+def rows_within_budget(dset,max_bytes):
+    """
+    Number of rows along the first axis of a dataset that fit in a memory budget.
+
+    If the dataset is chunked and at least one chunk fits, the number of rows
+    is rounded down to whole chunks so that each chunk is read only once.
+    Smaller budgets read part of a chunk at a time.
+
+    Args:
+        dset: h5py dataset (or anything with shape and dtype)
+        max_bytes (int): memory budget in bytes, or None for no limit
+
+    Returns:
+        int: number of rows to read at a time (at least 1)
+    """
+    numrows = dset.shape[0] if dset.shape else 1
+    if max_bytes is None:
+        return max(numrows,1)
+    rows = max(1,min(numrows,max_bytes//max(row_nbytes(dset),1)))
+    chunks = getattr(dset,'chunks',None)
+    if chunks and rows < numrows and rows >= chunks[0]:
+        rows -= rows % chunks[0]
+    return rows
+
+
+class WriteBuffer:
+    """
+    Buffer slices of data along the first axis and write them to an
+    h5py file once the buffered data would exceed a memory budget.
+
+    Call reserve before reading a slice so that buffered data and the
+    slice being read together stay within the budget.
+    """
+    def __init__(self, outfile, max_bytes=None):
+        """
+        Args:
+            outfile: h5py file (or group) to write to
+            max_bytes (int): memory budget in bytes; None writes through immediately
+        """
+        self.outfile = outfile
+        self.max_bytes = max_bytes
+        self.items = []
+        self.nbytes = 0
+
+    def reserve(self, nbytes):
+        """Flush if nbytes more would not fit in the buffer"""
+        if self.max_bytes is not None and self.nbytes+nbytes > self.max_bytes:
+            self.flush()
+
+    def add(self, name, start, data):
+        """Add data to be written to outfile[name][start:start+len(data)]"""
+        if self.max_bytes is None:
+            self.outfile[name][start:start+len(data)] = data
+            return
+        self.reserve(data.nbytes)
+        self.items.append((name,start,data))
+        self.nbytes += data.nbytes
+
+    def flush(self):
+        """Write all buffered data to outfile, grouped by dataset and in order"""
+        if not self.items:
+            return
+        logger.debug('Flushing {} buffered slices ({} bytes).'.format(len(self.items),self.nbytes))
+        for name,start,data in sorted(self.items,key=lambda item: item[:2]):
+            self.outfile[name][start:start+len(data)] = data
+        self.items = []
+        self.nbytes = 0